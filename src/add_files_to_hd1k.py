@@ -3,6 +3,7 @@
 
 import sys
 import os
+import mmap
 import struct
 
 # hd1k disk parameters (matching RomWBW format)
@@ -12,44 +13,52 @@ BLOCK_SIZE = 4096  # 8 sectors per block
 DIR_ENTRIES = 512
 BOOT_TRACKS = 1  # First track is boot area
 DIR_START = BOOT_TRACKS * SECTORS_PER_TRACK * SECTOR_SIZE  # 0x4000
-
-def find_free_dir_entry(disk_data):
-    """Find first free directory entry (starts with 0xE5)."""
-    for i in range(DIR_ENTRIES):
-        offset = DIR_START + (i * 32)
-        if disk_data[offset] == 0xE5:
-            return offset
-    return None
-
-def find_max_block(disk_data):
-    """Find highest used block number in directory."""
+DIR_SIZE = DIR_ENTRIES * 32  # Each entry is 32 bytes
+DIR_PTRS = struct.Struct('<8H')  # Allocation map: 8 16-bit block pointers at offset 16
+# Whole directory entry: user, name+ext, EX, S1, S2, RC, allocation map
+DIR_ENTRY = struct.Struct('<B11s4B8H')
+# CP/M EOF fill for the unused tail of a block (a view, so slicing doesn't copy)
+EOF_PAD = memoryview(b'\x1a' * BLOCK_SIZE)
+
+def cpm_name(filename):
+    """Return the 11-byte CP/M directory name: 8.3, uppercase, space-padded."""
+    name = filename.upper().encode('ascii')
+    dot = name.rfind(b'.')
+    base, ext = (name[:dot], name[dot + 1:]) if dot >= 0 else (name, b'')
+    cpm = bytearray(b' ' * 11)
+    cpm[:min(len(base), 8)] = base[:8]
+    cpm[8:8 + min(len(ext), 3)] = ext[:3]
+    return bytes(cpm)
+
+def dir_users(disk_data):
+    """Return the first (user) byte of every directory entry as one bytes object."""
+    return bytes(disk_data[DIR_START:DIR_START + DIR_SIZE:32])
+
+def scan_dir(disk_data):
+    """Scan the directory once for free entries and the highest used block.
+
+    Returns (free_offsets, max_block): offsets of entries starting with
+    0xE5, in order, and the highest block number in any in-use entry.
+    """
+    free_offsets = []
     max_block = 0
-    for i in range(DIR_ENTRIES):
+    for i, user in enumerate(dir_users(disk_data)):
         offset = DIR_START + (i * 32)
-        if disk_data[offset] != 0xE5:
+        if user == 0xE5:
+            free_offsets.append(offset)
+        else:
             # Check allocation map (bytes 16-31, 16-bit block pointers)
-            for j in range(8):
-                block = struct.unpack('<H', disk_data[offset+16+j*2:offset+18+j*2])[0]
+            for block in DIR_PTRS.unpack_from(disk_data, offset + 16):
                 if block > max_block and block < 0xFFFF:
                     max_block = block
-    return max_block
-
-def add_file(disk_data, filename, file_data):
-    """Add a file to the disk image."""
-    # Find free directory entry
-    dir_offset = find_free_dir_entry(disk_data)
-    if dir_offset is None:
-        print(f"No free directory entry for {filename}")
-        return False
+    return free_offsets, max_block
 
-    # Find next free block
-    next_block = find_max_block(disk_data) + 1
-
-    # Parse filename (8.3 format)
-    name, ext = filename.upper().split('.')
-    name = name.ljust(8)[:8]
-    ext = ext.ljust(3)[:3]
+def add_file(disk_data, filename, file_data, dirty, dir_offset, next_block):
+    """Add a file at directory entry dir_offset with data starting at next_block.
 
+    The pages it modifies are added to dirty. Returns the number of blocks
+    used, or None if the file could not be added.
+    """
     # Calculate number of records (128 bytes each)
     num_records = (len(file_data) + 127) // 128
 
@@ -57,39 +66,101 @@ def add_file(disk_data, filename, file_data):
     records_per_block = BLOCK_SIZE // 128  # 32 records per 4KB block
     blocks_needed = (num_records + records_per_block - 1) // records_per_block
 
-    print(f"Adding {filename}: {len(file_data)} bytes, {num_records} records, {blocks_needed} blocks starting at {next_block}")
+    # The mapped image cannot grow, so the file must fit inside it
+    if DIR_START + ((next_block + blocks_needed) * BLOCK_SIZE) > len(disk_data):
+        print(f"No room on disk for {filename}")
+        return None
 
-    # Create directory entry
-    entry = bytearray(32)
-    entry[0] = 0  # User 0
-    entry[1:9] = name.encode('ascii')
-    entry[9:12] = ext.encode('ascii')
-    entry[12] = 0  # Extent low
-    entry[13] = 0  # S1
-    entry[14] = 0  # S2
-    entry[15] = min(num_records, 128)  # Record count (max 128 per extent)
+    print(f"Adding {filename}: {len(file_data)} bytes, {num_records} records, {blocks_needed} blocks starting at {next_block}")
 
     # Allocation map (16-bit block pointers)
-    for i in range(min(blocks_needed, 8)):
-        struct.pack_into('<H', entry, 16 + i*2, next_block + i)
-
-    # Write directory entry
-    disk_data[dir_offset:dir_offset+32] = entry
-
-    # Write file data to blocks
+    blocks = list(range(next_block, next_block + min(blocks_needed, 8)))
+
+    # Write directory entry straight into the image
+    DIR_ENTRY.pack_into(disk_data, dir_offset,
+                        0,  # User 0
+                        cpm_name(filename),  # Name and extension (8.3 format)
+                        0, 0, 0,  # Extent low, S1, S2
+                        min(num_records, 128),  # Record count (max 128 per extent)
+                        *blocks, *[0] * (8 - len(blocks)))
+    mark_dirty(dirty, dir_offset, 32)
+
+    # Write file data to blocks. The blocks are consecutive, so the whole
+    # file is one copy followed by the EOF pad for the last block.
     # Block 0 starts at DIR_START (after boot track), not at disk offset 0
-    for i in range(blocks_needed):
-        block_num = next_block + i
-        block_offset = DIR_START + (block_num * BLOCK_SIZE)
-        data_offset = i * BLOCK_SIZE
-        chunk = file_data[data_offset:data_offset + BLOCK_SIZE]
-        # Pad with 0x1A (CP/M EOF) if needed
-        if len(chunk) < BLOCK_SIZE:
-            chunk = chunk + bytes([0x1A] * (BLOCK_SIZE - len(chunk)))
-        disk_data[block_offset:block_offset + BLOCK_SIZE] = chunk
-
+    data_start = DIR_START + (next_block * BLOCK_SIZE)
+    data_size = blocks_needed * BLOCK_SIZE
+    disk_data[data_start:data_start + len(file_data)] = file_data
+    # Pad with 0x1A (CP/M EOF) if needed
+    tail = data_size - len(file_data)
+    if tail:
+        disk_data[data_start + len(file_data):data_start + data_size] = EOF_PAD[:tail]
+    mark_dirty(dirty, data_start, data_size)
+
+    return blocks_needed
+
+def add_files(disk_data, items, dirty):
+    """Add (filename, file_data) pairs, scanning the directory only once."""
+    free_offsets, max_block = scan_dir(disk_data)
+    free_entries = iter(free_offsets)
+    print(f"Max used block: {max_block}")
+
+    # Files are laid out back to back after the highest used block
+    next_block = max_block + 1
+    for filename, file_data in items:
+        dir_offset = next(free_entries, None)
+        if dir_offset is None:
+            print(f"No free directory entry for {filename}")
+            return False
+        blocks_used = add_file(disk_data, filename, file_data, dirty, dir_offset, next_block)
+        if blocks_used is None:
+            print(f"Failed to add {filename}")
+            return False
+        next_block += blocks_used
     return True
 
+def mark_dirty(dirty, offset, length):
+    """Add the pages covering offset..offset+length to the dirty page set."""
+    page = mmap.ALLOCATIONGRANULARITY
+    dirty.update(range(offset // page, (offset + length - 1) // page + 1))
+
+def open_disk(disk_path):
+    """Map the disk image read/write; changes go straight to the file's pages."""
+    fd = os.open(disk_path, os.O_RDWR)
+    try:
+        disk_data = mmap.mmap(fd, 0)
+    finally:
+        os.close(fd)  # mmap keeps its own descriptor
+    advise_disk(disk_data)
+    return disk_data
+
+def advise_disk(disk_data):
+    """Tell the kernel how the mapped image will be accessed, where supported."""
+    if not hasattr(disk_data, 'madvise'):  # Python 3.8+, not on Windows
+        return
+    page = mmap.PAGESIZE
+    # The whole directory is scanned up front, so read it in at once
+    start = DIR_START - (DIR_START % page)
+    disk_data.madvise(mmap.MADV_WILLNEED, start, DIR_START + DIR_SIZE - start)
+    # File data is written front to back in runs of consecutive blocks
+    data_start = DIR_START + DIR_SIZE
+    start = data_start - (data_start % page)
+    if start < len(disk_data):
+        disk_data.madvise(mmap.MADV_SEQUENTIAL, start, len(disk_data) - start)
+
+def flush_pages(disk_data, dirty):
+    """Flush the dirty pages back to the image, one flush per run of adjacent pages."""
+    page = mmap.ALLOCATIONGRANULARITY
+    runs = []
+    for p in sorted(dirty):
+        if runs and p == runs[-1][1]:
+            runs[-1][1] = p + 1
+        else:
+            runs.append([p, p + 1])
+    for first, end in runs:
+        offset = first * page
+        disk_data.flush(offset, min((end - first) * page, len(disk_data) - offset))
+
 def main():
     if len(sys.argv) < 4:
         print("Usage: add_files_to_hd1k.py <disk.img> <file1.com> [file2.com ...]")
@@ -98,26 +169,28 @@ def main():
     disk_path = sys.argv[1]
     files = sys.argv[2:]
 
-    # Read disk image
-    with open(disk_path, 'rb') as f:
-        disk_data = bytearray(f.read())
+    # Map disk image
+    disk_data = open_disk(disk_path)
 
     print(f"Disk size: {len(disk_data)} bytes")
     print(f"Directory at offset: 0x{DIR_START:X}")
-    print(f"Max used block: {find_max_block(disk_data)}")
 
-    # Add each file
+    # Read all files first so the directory is scanned once for the batch
+    items = []
     for filepath in files:
-        filename = os.path.basename(filepath)
         with open(filepath, 'rb') as f:
-            file_data = f.read()
-        if not add_file(disk_data, filename, file_data):
-            print(f"Failed to add {filename}")
-            sys.exit(1)
+            items.append((os.path.basename(filepath), f.read()))
+
+    # Add the files, recording which pages of the image they modify
+    dirty = set()
+    if not add_files(disk_data, items, dirty):
+        # Keep the files that were added before the failure
+        flush_pages(disk_data, dirty)
+        sys.exit(1)
 
-    # Write modified disk
-    with open(disk_path, 'wb') as f:
-        f.write(disk_data)
+    # Flush only the modified pages
+    flush_pages(disk_data, dirty)
+    disk_data.close()
 
     print("Done!")
 
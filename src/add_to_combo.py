@@ -3,6 +3,8 @@
 
 import sys
 import os
+import errno
+import itertools
 import struct
 
 # hd1k combo disk parameters
@@ -16,81 +18,137 @@ BOOT_TRACKS = 2
 # Combo disk: 1MB prefix, then slices
 PREFIX_SIZE = 1048576  # 1MB
 SLICE_SIZE = 8388608   # 8MB
+NUM_BLOCKS = (SLICE_SIZE - (BOOT_TRACKS * TRACK_SIZE)) // BLOCK_SIZE  # 2044 blocks after the boot tracks
 
 # Directory starts after prefix + boot tracks
 DIR_OFFSET = PREFIX_SIZE + (BOOT_TRACKS * TRACK_SIZE)  # 1MB + 16KB = 0x104000
 DIR_SIZE = DIR_ENTRIES * 32  # Each entry is 32 bytes
+DIR_PTRS = struct.Struct('<8H')  # Allocation map: 8 16-bit block pointers at offset 16
+# Whole directory entry: user, name+ext, EX, S1, S2, RC, allocation map
+DIR_ENTRY = struct.Struct('<B11s4B8H')
+# CP/M EOF fill for the unused tail of a block (a view, so slicing doesn't copy)
+EOF_PAD = memoryview(b'\x1a' * BLOCK_SIZE)
 
 # Data area starts after directory
 # Directory uses blocks 0-7 (8 blocks × 4KB = 32KB for 1024 entries)
 DATA_OFFSET = PREFIX_SIZE + (BOOT_TRACKS * TRACK_SIZE) + (8 * BLOCK_SIZE)
 
-def find_free_dir_entry(disk_data):
-    """Find first free directory entry (starts with 0xE5)."""
-    for i in range(DIR_ENTRIES):
-        entry_offset = DIR_OFFSET + (i * 32)
-        if disk_data[entry_offset] == 0xE5:
-            return i
-    return -1
+def cpm_name(filename):
+    """Return the 11-byte CP/M directory name: 8.3, uppercase, space-padded."""
+    name = filename.upper().encode('ascii')
+    dot = name.rfind(b'.')
+    base, ext = (name[:dot], name[dot + 1:]) if dot >= 0 else (name, b'')
+    cpm = bytearray(b' ' * 11)
+    cpm[:min(len(base), 8)] = base[:8]
+    cpm[8:8 + min(len(ext), 3)] = ext[:3]
+    return bytes(cpm)
 
-def find_free_block(disk_data, used_blocks):
-    """Find first free block (skip blocks 0-7 used by directory)."""
+def dir_users(dir_data):
+    """Return the first (user) byte of every directory entry as one bytes object."""
+    return bytes(dir_data[::32])
+
+def free_dir_entries(dir_data):
+    """Yield indices of free directory entries (starting with 0xE5) in order."""
+    users = dir_users(dir_data)
+    i = users.find(0xE5)
+    while i >= 0:
+        yield i
+        i = users.find(0xE5, i + 1)
+
+def find_free_block(used_blocks, cursor):
+    """Find first free block at or after cursor[0] and move the cursor past it.
+
+    Blocks are never freed while adding files, so every block below the
+    cursor stays used and the search never has to restart from block 8.
+    """
     # Blocks 0-7 are for directory, data starts at block 8
-    # Total blocks per slice: 8MB / 4KB = 2048 blocks
-    for block in range(8, 2048):
-        if block not in used_blocks:
-            return block
-    return -1
-
-def get_used_blocks(disk_data):
-    """Scan directory to find all used blocks."""
-    used = set(range(8))  # Directory blocks are always used
-    for i in range(DIR_ENTRIES):
-        entry_offset = DIR_OFFSET + (i * 32)
-        user = disk_data[entry_offset]
-        if user != 0xE5 and user < 32:  # Valid user number
-            # Block pointers are at offset 16-31 (16 bytes, 8 16-bit pointers)
-            for j in range(8):
-                ptr_offset = entry_offset + 16 + (j * 2)
-                block = struct.unpack('<H', disk_data[ptr_offset:ptr_offset+2])[0]
-                if block != 0:
-                    used.add(block)
+    # Total blocks per slice: (8MB - 16KB boot tracks) / 4KB = 2044 blocks
+    # A free block is a zero byte in the bitmap; find() searches for it in C
+    block = used_blocks.find(0, cursor[0])
+    if block < 0:
+        return -1
+    cursor[0] = block + 1
+    return block
+
+def find_free_run(used_blocks, count, start=8):
+    """Find first block of a run of count consecutive free blocks, or -1."""
+    # A free run is a run of zero bytes in the bitmap
+    return used_blocks.find(bytes(count), start)
+
+def get_used_blocks(dir_data):
+    """Scan directory to build a bitmap of used blocks (one byte per block, 1 = used)."""
+    used = bytearray(NUM_BLOCKS)
+    used[:8] = b'\x01' * 8  # Directory blocks are always used
+    for i, user in enumerate(dir_users(dir_data)):
+        if user < 32:  # Valid user number (0xE5 marks a free entry)
+            # Block pointers are at offset 16-31 (16 bytes, 8 16-bit pointers).
+            # Unused pointers are 0, which is already marked. Only in-use
+            # entries are decoded, which is faster on a mostly empty directory.
+            for block in DIR_PTRS.unpack_from(dir_data, (i * 32) + 16):
+                if block < NUM_BLOCKS:
+                    used[block] = 1
     return used
 
-def add_file(disk_data, filename, file_data, user=0):
-    """Add a file to the disk image."""
-    # CP/M filename: 8 chars name + 3 chars extension, uppercase, space-padded
-    name, ext = os.path.splitext(filename.upper())
-    name = name[:8].ljust(8)
-    ext = ext[1:4].ljust(3) if ext else '   '
+def block_runs(blocks):
+    """Yield (index, first_block, count) for each run of consecutive block numbers."""
+    start = 0
+    for i in range(1, len(blocks) + 1):
+        if i == len(blocks) or blocks[i] != blocks[i - 1] + 1:
+            yield start, blocks[start], i - start
+            start = i
+
+def allocate_file(filename, file_data, used_blocks, free_entries, cursor):
+    """Reserve directory entries and data blocks for a file.
 
-    # Calculate number of records (128 bytes each) and extents
-    num_records = (len(file_data) + 127) // 128
+    used_blocks, free_entries and cursor are the allocation state from
+    add_files, shared by every file in a batch and updated as it goes.
+    Returns (dir_indices, allocated_blocks), or None if the file does not fit.
+    """
     num_blocks = (len(file_data) + BLOCK_SIZE - 1) // BLOCK_SIZE
 
-    # Get currently used blocks
-    used_blocks = get_used_blocks(disk_data)
+    # One directory entry per extent (up to 8 block pointers each)
+    num_extents = (num_blocks + 7) // 8
+    dir_indices = list(itertools.islice(free_entries, num_extents))
+    if len(dir_indices) < num_extents:
+        print(f"Error: No free directory entry for {filename}")
+        return None
 
-    # Allocate blocks for file
-    allocated_blocks = []
-    for _ in range(num_blocks):
-        block = find_free_block(disk_data, used_blocks)
-        if block < 0:
-            print(f"Error: No free blocks for {filename}")
-            return False
-        allocated_blocks.append(block)
-        used_blocks.add(block)
-
-    # Write file data to blocks
-    for i, block in enumerate(allocated_blocks):
-        block_offset = PREFIX_SIZE + (block * BLOCK_SIZE)
-        start = i * BLOCK_SIZE
-        end = min(start + BLOCK_SIZE, len(file_data))
-        chunk = file_data[start:end]
+    # Allocate blocks for file, preferring one contiguous run so the data is
+    # a single copy. Otherwise take scattered free blocks from the cursor.
+    run_start = find_free_run(used_blocks, num_blocks, cursor[0]) if num_blocks else -1
+    if run_start >= 0:
+        allocated_blocks = list(range(run_start, run_start + num_blocks))
+        used_blocks[run_start:run_start + num_blocks] = b'\x01' * num_blocks
+    else:
+        allocated_blocks = []
+        for _ in range(num_blocks):
+            block = find_free_block(used_blocks, cursor)
+            if block < 0:
+                print(f"Error: No free blocks for {filename}")
+                return None
+            allocated_blocks.append(block)
+            used_blocks[block] = 1
+
+    return dir_indices, allocated_blocks
+
+def write_payload(fd, file_data, allocated_blocks):
+    """Write file data to its blocks, one write per run of consecutive blocks."""
+    data = memoryview(file_data)  # Slice runs out without copying them first
+    for i, block, count in block_runs(allocated_blocks):
+        # Block 0 starts at DIR_OFFSET (after the boot tracks), not at the slice start
+        run_offset = DIR_OFFSET + (block * BLOCK_SIZE)
+        run_size = count * BLOCK_SIZE
+        chunk = data[i * BLOCK_SIZE:(i + count) * BLOCK_SIZE]
         # Pad with 0x1A (CP/M EOF) if needed
-        if len(chunk) < BLOCK_SIZE:
-            chunk = chunk + bytes([0x1A] * (BLOCK_SIZE - len(chunk)))
-        disk_data[block_offset:block_offset+BLOCK_SIZE] = chunk
+        if len(chunk) < run_size:
+            write_at(fd, [chunk, EOF_PAD[:run_size - len(chunk)]], run_offset)
+        else:
+            write_at(fd, [chunk], run_offset)
+
+def write_dir_entries(dir_data, filename, file_data, dir_indices, allocated_blocks, user=0):
+    """Fill in the directory entries (extents) describing an allocated file."""
+    # CP/M filename: 8 chars name + 3 chars extension, built once for all extents
+    name = cpm_name(filename)
 
     # Create directory entries (one extent can hold up to 8 block pointers = 32KB)
     # For files up to 32KB, we need one extent
@@ -100,46 +158,102 @@ def add_file(disk_data, filename, file_data, user=0):
     block_idx = 0
 
     while block_idx < len(allocated_blocks):
-        dir_idx = find_free_dir_entry(disk_data)
-        if dir_idx < 0:
-            print(f"Error: No free directory entry for {filename}")
-            return False
-
-        entry_offset = DIR_OFFSET + (dir_idx * 32)
-
-        # Build directory entry
-        entry = bytearray(32)
-        entry[0] = user  # User number
-        entry[1:9] = name.encode('ascii')  # Filename
-        entry[9:12] = ext.encode('ascii')  # Extension
-        entry[12] = extent_num & 0x1F  # Extent low (EX)
-        entry[13] = 0  # S1 (reserved)
-        entry[14] = (extent_num >> 5) & 0x3F  # Extent high (S2)
+        entry_offset = dir_indices[extent_num] * 32
 
         # Calculate records in this extent
         extent_blocks = allocated_blocks[block_idx:block_idx+blocks_per_extent]
-        extent_bytes = len(extent_blocks) * BLOCK_SIZE
         if block_idx + blocks_per_extent >= len(allocated_blocks):
             # Last extent - actual record count
             remaining = len(file_data) - (block_idx * BLOCK_SIZE)
             extent_records = (remaining + 127) // 128
         else:
             extent_records = 128  # Full extent
-        entry[15] = min(extent_records, 128)  # RC (record count, max 128)
-
-        # Block pointers (16-bit, little-endian)
-        for i, block in enumerate(extent_blocks):
-            struct.pack_into('<H', entry, 16 + i*2, block)
 
-        # Write entry to disk
-        disk_data[entry_offset:entry_offset+32] = entry
+        # Write directory entry straight into the directory buffer
+        DIR_ENTRY.pack_into(dir_data, entry_offset,
+                            user,  # User number
+                            name,  # Filename and extension
+                            extent_num & 0x1F,  # Extent low (EX)
+                            0,  # S1 (reserved)
+                            (extent_num >> 5) & 0x3F,  # Extent high (S2)
+                            min(extent_records, 128),  # RC (record count, max 128)
+                            # Block pointers (16-bit, little-endian)
+                            *extent_blocks, *[0] * (8 - len(extent_blocks)))
 
         block_idx += blocks_per_extent
         extent_num += 1
 
-    print(f"Added {filename}: {len(file_data)} bytes, {num_blocks} blocks")
+    print(f"Added {filename}: {len(file_data)} bytes, {len(allocated_blocks)} blocks")
+
+def add_files(fd, dir_data, items, user=0):
+    """Add (filename, file_data) pairs, scanning the directory only once.
+
+    dir_data is the slice 0 directory read from the image. Every file is
+    allocated before anything is written, so a batch that does not fit
+    leaves the image unchanged.
+    """
+    used_blocks = get_used_blocks(dir_data)
+    free_entries = free_dir_entries(dir_data)
+    cursor = [8]  # Lowest block that may be free; data starts at block 8
+    layout = []
+    for filename, file_data in items:
+        allocation = allocate_file(filename, file_data, used_blocks, free_entries, cursor)
+        if allocation is None:
+            return False
+        layout.append((filename, file_data) + allocation)
+
+    # Allocations never overlap, so file data can be written in any order.
+    # Write it before the directory so the entries never point at stale data.
+    for filename, file_data, dir_indices, allocated_blocks in layout:
+        write_payload(fd, file_data, allocated_blocks)
+    for filename, file_data, dir_indices, allocated_blocks in layout:
+        write_dir_entries(dir_data, filename, file_data, dir_indices, allocated_blocks, user)
+    write_at(fd, [dir_data], DIR_OFFSET)
     return True
 
+def read_at(fd, buf, offset):
+    """Fill buf from the image at offset, returning the number of bytes read.
+
+    Fewer than len(buf) bytes are read only if the image ends first.
+    """
+    vectored = hasattr(os, 'preadv')  # Otherwise (Windows) seek, then read
+    view = memoryview(buf)
+    total = 0
+    while total < len(buf):
+        if vectored:
+            n = os.preadv(fd, [view[total:]], offset + total)
+        else:
+            os.lseek(fd, offset + total, os.SEEK_SET)
+            data = os.read(fd, len(buf) - total)
+            n = len(data)
+            view[total:total + n] = data
+        if n == 0:
+            break
+        total += n
+    return total
+
+def write_at(fd, buffers, offset):
+    """Write buffers back to back at offset in the image, retrying short writes."""
+    vectored = hasattr(os, 'pwritev')  # Otherwise (Windows) seek, then write
+    views = [memoryview(buf) for buf in buffers if len(buf)]
+    while views:
+        if vectored:
+            n = os.pwritev(fd, views, offset)
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            n = os.write(fd, views[0])
+        if n == 0:
+            raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+        offset += n
+        # Drop whatever was written and carry on with the rest
+        while n:
+            if n >= len(views[0]):
+                n -= len(views[0])
+                views.pop(0)
+            else:
+                views[0] = views[0][n:]
+                n = 0
+
 def main():
     if len(sys.argv) < 3:
         print("Usage: add_to_combo.py <combo.img> <file1.com> [file2.com ...]")
@@ -148,26 +262,34 @@ def main():
     disk_path = sys.argv[1]
     files = sys.argv[2:]
 
-    # Read disk image
-    with open(disk_path, 'rb') as f:
-        disk_data = bytearray(f.read())
-
-    # Check it's a combo disk (has 1MB prefix)
-    if len(disk_data) < PREFIX_SIZE + SLICE_SIZE:
-        print(f"Error: {disk_path} is too small to be a combo disk")
-        sys.exit(1)
+    # Only the slice 0 directory is read; file data is written without
+    # reading the rest of the image
+    fd = os.open(disk_path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+    try:
+        # Check it's a combo disk (has 1MB prefix)
+        if os.fstat(fd).st_size < PREFIX_SIZE + SLICE_SIZE:
+            print(f"Error: {disk_path} is too small to be a combo disk")
+            sys.exit(1)
 
-    # Add each file
-    for filepath in files:
-        filename = os.path.basename(filepath)
-        with open(filepath, 'rb') as f:
-            file_data = f.read()
-        if not add_file(disk_data, filename, file_data):
+        dir_data = bytearray(DIR_SIZE)
+        if read_at(fd, dir_data, DIR_OFFSET) != DIR_SIZE:
+            print(f"Error: could not read the directory of {disk_path}")
             sys.exit(1)
 
-    # Write modified disk
-    with open(disk_path, 'wb') as f:
-        f.write(disk_data)
+        # Read all files first so the directory is scanned once for the batch
+        items = []
+        for filepath in files:
+            with open(filepath, 'rb') as f:
+                items.append((os.path.basename(filepath), f.read()))
+
+        try:
+            if not add_files(fd, dir_data, items):
+                sys.exit(1)
+        except OSError as e:
+            print(f"Error: writing {disk_path} failed: {e}")
+            sys.exit(1)
+    finally:
+        os.close(fd)
 
     print(f"Successfully updated {disk_path}")
 